@@ -3,6 +3,10 @@ import numpy as np
 import logging
 import enlighten
 import argparse
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
@@ -16,6 +20,10 @@ class ColorMapMaker:
         color_section_size: int,
         flip_to_vertical: bool,
         sampling_interval: int,
+        use_seeking: bool = False,
+        workers: Optional[int] = None,
+        use_cuda: bool = False,
+        average_sections: bool = False,
     ):
         """
         :param video_file_path: Path to input video file of which color map will be created. Format support is determined by OpenCV support.
@@ -24,68 +32,241 @@ class ColorMapMaker:
         :param color_section_size: Size in pixels (height or width depending if image is horizontal or vertical) of mean color segment in the result image.
         :param flip_to_vertical: Decides whether image is presented vertically or horizontally
         :param sampling_interval: Number of frames between which mean color values is sampled (default 24 is one sample per second for most movies)
+        :param use_seeking: Decides whether sampled frames are reached by seeking instead of grabbing every frame in between.
+                            Faster for videos with dense keyframes, might be slower for videos with sparse ones.
+        :param workers: Number of threads processing the video in parallel, each one with its own video capture.
+                        Every worker seeks to its part of the video, so it is only used together with seeking,
+                        and relies on seeking being accurate for loaded video. Defaults to number of CPUs.
+        :param use_cuda: Decides whether video is decoded and reduced on GPU. Requires OpenCV built with CUDA and cudacodec,
+                         falls back to CPU processing otherwise.
+        :param average_sections: Decides whether mean color of a section is averaged over all of its frames instead of
+                                 being sampled from its first frame. More accurate, but every frame has to be decoded.
         """
-        self._video = cv2.VideoCapture(video_file_path)
+        self._video_file_path = video_file_path
         self._image_size = image_size
         self._color_section_size = color_section_size
         self._flip_to_vertical = flip_to_vertical
+        self._sampling_interval = sampling_interval
+        self._use_seeking = use_seeking
+        self._progress_bar_lock = threading.Lock()
+        self._use_cuda = use_cuda
+        self._average_sections = average_sections
         logger.debug(
             f"Received following attributes: \n"
             + f" -video path = {video_file_path}\n"
             + f" -image_size = {image_size}\n"
             + f" -color_section_size = {color_section_size}\n"
             + f" -flip_to_vertical = {flip_to_vertical}\n"
-            + f" -sampling_interval = {sampling_interval}"
+            + f" -sampling_interval = {sampling_interval}\n"
+            + f" -use_seeking = {use_seeking}\n"
+            + f" -workers = {workers}\n"
+            + f" -use_cuda = {use_cuda}\n"
+            + f" -average_sections = {average_sections}"
         )
+        if self._average_sections and self._use_seeking:
+            logger.warning("Every frame is decoded when averaging sections, seeking will not be used.")
+            self._use_seeking = False
+        if self._use_cuda and not (hasattr(cv2, "cudacodec") and cv2.cuda.getCudaEnabledDeviceCount() > 0):
+            logger.warning("CUDA is not available in loaded OpenCV build, falling back to CPU processing.")
+            self._use_cuda = False
+        if self._use_seeking:
+            self._workers = max(workers if workers is not None else (os.cpu_count() or 1), 1)
+        else:
+            if workers is not None and workers > 1:
+                logger.warning("Parallel workers have to seek to their part of the video, processing it with single worker as seeking is disabled.")
+            self._workers = 1
+        # Used only to read video metadata, so no hardware decoder is requested for it
+        self._video = cv2.VideoCapture(video_file_path)
         self._total_video_frames = int(self._video.get(cv2.CAP_PROP_FRAME_COUNT))
         if self._total_video_frames == 0:
             logger.error('Video was not loaded correctly, exiting.')
             exit(1)
-        number_of_color_sections = self._total_video_frames // sampling_interval
+        self._number_of_color_sections = self._total_video_frames // sampling_interval
         logger.debug(
-            f"Detected {self._total_video_frames} frames in loaded video, sampling {number_of_color_sections} colors"
+            f"Detected {self._total_video_frames} frames in loaded video, sampling {self._number_of_color_sections} colors"
         )
 
-        self.result_image = np.zeros(
-            [self._image_size, self._color_section_size * number_of_color_sections, 3]
-        )
+        # Only one color per section is stored, full color map is built from it when it is needed
+        self._colors = np.zeros([self._number_of_color_sections, 3], dtype=np.uint8)
 
     def process_image(self) -> None:
         """
-        Processes loaded file and creates color map in memory. 
+        Processes loaded file and creates color map in memory. Video is split into consecutive ranges of
+        color sections, each one processed by separate worker with its own video capture.
         """
         logger.info("Started processing loaded image.")
         manager = enlighten.get_manager()
+        # Frames after the last full color section are never processed
         progress_bar = manager.counter(
-            total=self._total_video_frames, desc="Processed frames", unit="Frames"
+            total=self._number_of_color_sections * self._sampling_interval,
+            desc="Processed frames",
+            unit="Frames",
         )
-        processed_frame_n = 0
-        processed_color_section_n = 0
-        for processed_frame_n in range(self._total_video_frames):
-            retval, image = self._video.read()  # Grab a frame from loaded video
-            if retval:
-                if processed_frame_n % 24 == 0:
-                    mean_color = np.mean(image, axis=(0, 1))
-                    mean_image = (
-                        np.ones([self._image_size, self._color_section_size, 3])
-                        * mean_color
-                    )
-                    # Assign image with mean color as a section in result image
-                    self.result_image[
-                        :,
-                        (processed_color_section_n * self._color_section_size) : (
-                            processed_color_section_n * self._color_section_size
-                            + self._color_section_size
-                        ),
-                        :,
-                    ] = mean_image
-                    processed_color_section_n += 1
+        if self._use_cuda:
+            self._process_sections_cuda(progress_bar)
+            return
+        sections_per_worker = max(-(-self._number_of_color_sections // self._workers), 1)
+        section_ranges = [
+            range(first_section_n, min(first_section_n + sections_per_worker, self._number_of_color_sections))
+            for first_section_n in range(0, self._number_of_color_sections, sections_per_worker)
+        ]
+        # Decoding releases GIL, and every worker writes to its own sections, so threads are enough
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            list(
+                executor.map(
+                    lambda section_range: self._process_sections(section_range, progress_bar),
+                    section_ranges,
+                )
+            )
+
+    def _process_sections(self, section_range: range, progress_bar: enlighten.Counter) -> None:
+        """
+        Samples mean colors of given consecutive color sections and stores them in per-section colors array.
+
+        :param section_range: Range of color sections numbers to process.
+        :param progress_bar: Progress bar shared by all workers.
+        """
+        video = self._open_video()
+        if section_range.start == 0 and video.get(cv2.CAP_PROP_HW_ACCELERATION) == cv2.VIDEO_ACCELERATION_NONE:
+            logger.info("Hardware accelerated decoding is not available for loaded video, decoding in software.")
+        use_seeking = self._use_seeking
+        # Allocated by first retrieved frame, then decoded frames are written into it
+        frame_buffer = None
+        for processed_color_section_n in section_range:
+            if use_seeking:
+                seek_accurate = self._seek_to_frame(
+                    video, processed_color_section_n * self._sampling_interval
+                )
+                use_seeking = use_seeking and seek_accurate
+            retval, frame_buffer = (
+                video.retrieve(frame_buffer) if video.grab() else (False, frame_buffer)
+            )  # Grab a frame from loaded video
+            if not retval:
+                break
+            processed_frames_n = 1
+            if self._average_sections:
+                # Every frame of the section is decoded and contributes to its mean color
+                color_sum = np.array(cv2.mean(frame_buffer)[:3])
+                while processed_frames_n < self._sampling_interval and video.grab():
+                    retval, frame_buffer = video.retrieve(frame_buffer)
+                    if not retval:
+                        break
+                    color_sum += cv2.mean(frame_buffer)[:3]
+                    processed_frames_n += 1
+                mean_color = color_sum / processed_frames_n
             else:
+                mean_color = np.array(cv2.mean(frame_buffer)[:3])
+                if use_seeking:
+                    processed_frames_n = self._sampling_interval
+                else:
+                    # Frames between samples are only grabbed, without being decoded
+                    while processed_frames_n < self._sampling_interval and video.grab():
+                        processed_frames_n += 1
+            self._set_section_color(processed_color_section_n, mean_color)
+            self._update_progress_bar(progress_bar, processed_frames_n)
+        video.release()
+
+    def _open_video(self) -> cv2.VideoCapture:
+        """
+        Opens separate capture of loaded video. FFmpeg backend is preferred, as it can use hardware accelerated
+        decoding when available. It also decodes using multiple threads on its own, so available CPUs are divided
+        between workers instead of every capture spawning thread per CPU.
+        """
+        params = [cv2.CAP_PROP_HW_ACCELERATION, cv2.VIDEO_ACCELERATION_ANY]
+        # Thread count property is only available since OpenCV 4.7, and FFmpeg refuses to open capture with unknown one
+        n_threads_property = getattr(cv2, "CAP_PROP_N_THREADS", None)
+        if n_threads_property is not None:
+            params += [n_threads_property, max((os.cpu_count() or 1) // self._workers, 1)]
+        video = cv2.VideoCapture(self._video_file_path, cv2.CAP_FFMPEG, params)
+        if not video.isOpened():
+            logger.debug("Video could not be opened with FFmpeg backend, letting OpenCV choose another one.")
+            video = cv2.VideoCapture(self._video_file_path)
+        # Keep decoder from queueing frames ahead, only every n-th one is ever used
+        video.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        return video
+
+    def _process_sections_cuda(self, progress_bar: enlighten.Counter) -> None:
+        """
+        Samples mean colors of all color sections and stores them in per-section colors array, decoding and reducing frames on GPU.
+        Only mean color of processed frames is transferred back to host memory.
+
+        :param progress_bar: Progress bar tracking processed frames.
+        """
+        reader = cv2.cudacodec.createVideoReader(self._video_file_path)
+        color_sum = np.zeros(3)
+        processed_frames_n = 0
+        for processed_frame_n in range(self._number_of_color_sections * self._sampling_interval):
+            retval, gpu_frame = reader.nextFrame()
+            if not retval:
                 break
-            progress_bar.update()
+            processed_frames_n = processed_frame_n + 1
+            processed_color_section_n, section_frame_n = divmod(processed_frame_n, self._sampling_interval)
+            if self._average_sections:
+                color_sum += self._gpu_frame_mean_color(gpu_frame)
+                if section_frame_n == self._sampling_interval - 1:
+                    self._set_section_color(processed_color_section_n, color_sum / self._sampling_interval)
+                    color_sum[:] = 0
+            elif section_frame_n == 0:
+                self._set_section_color(processed_color_section_n, self._gpu_frame_mean_color(gpu_frame))
+            # Progress bar is updated once per color section to keep it out of per-frame work
+            if processed_frames_n % self._sampling_interval == 0:
+                progress_bar.update(self._sampling_interval)
+        section_frames_n = processed_frames_n % self._sampling_interval
+        if self._average_sections and section_frames_n > 0:
+            # Video ended before the last section was complete, its color is averaged over frames it had
+            self._set_section_color(processed_frames_n // self._sampling_interval, color_sum / section_frames_n)
+        # Report frames of the last section if video ended before it was complete
+        progress_bar.update(section_frames_n)
+
+    def _set_section_color(self, color_section_n: int, mean_color: np.ndarray) -> None:
+        # Mean color is rounded, not truncated, same as OpenCV does when saving floating point image
+        self._colors[color_section_n] = np.rint(mean_color).astype(np.uint8)
+
+    @staticmethod
+    def _gpu_frame_mean_color(gpu_frame: cv2.cuda_GpuMat) -> np.ndarray:
+        width, height = gpu_frame.size()
+        # Decoded frames are BGRA, alpha channel sum is dropped
+        return np.array(cv2.cuda.sum(gpu_frame)[:3]) / (width * height)
+
+    def _update_progress_bar(self, progress_bar: enlighten.Counter, incr: int = 1) -> None:
+        with self._progress_bar_lock:
+            progress_bar.update(incr)
+
+    @staticmethod
+    def _seek_to_frame(video: cv2.VideoCapture, frame_n: int) -> bool:
+        """
+        Moves given video to given frame. Seeking accuracy is codec dependent, so if video did not land
+        on requested frame, frames are grabbed from the beginning of the video instead. Some backends (e.g. FFmpeg)
+        report requested position after seeking, so not every inaccurate seek can be detected this way.
+
+        :return: Whether seeking was accurate and can be relied upon.
+        """
+        video.set(cv2.CAP_PROP_POS_FRAMES, frame_n)
+        if int(video.get(cv2.CAP_PROP_POS_FRAMES)) == frame_n:
+            return True
+        logger.warning("Seeking in loaded video is not accurate, falling back to grabbing frames.")
+        video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        for _ in range(frame_n):
+            video.grab()
+        return False
+
+    @property
+    def result_image(self) -> np.ndarray:
+        """
+        Color map built from sampled colors, every color repeated over its section and broadcasted along image size.
+        Every access builds a new full size image, so it should not be read repeatedly.
+        """
+        section_colors = np.repeat(self._colors, self._color_section_size, axis=0)
         if self._flip_to_vertical:
-            self.result_image = cv2.rotate(self.result_image, cv2.ROTATE_90_CLOCKWISE)
-    
+            result_image = np.broadcast_to(
+                section_colors[:, np.newaxis, :], (len(section_colors), self._image_size, 3)
+            )
+        else:
+            result_image = np.broadcast_to(
+                section_colors[np.newaxis, :, :], (self._image_size, len(section_colors), 3)
+            )
+        return np.ascontiguousarray(result_image)
+
     def save_result_to_file(self, output_file_path: str) -> None:
         retval = cv2.imwrite(output_file_path, self.result_image)
         if retval:
@@ -144,6 +325,35 @@ if __name__ == "__main__":
         required=False,
         help="Number of frames between which mean color values is sampled. Default is 24, one sample per second for most movies.",
     )
+    parser.add_argument(
+        "-sk",
+        "--seek",
+        required=False,
+        action="store_true",
+        help="Reach sampled frames by seeking instead of grabbing every frame in between. Faster for videos with dense keyframes, might be slower for others.",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        default=None,
+        type=int,
+        required=False,
+        help="Number of threads processing the video in parallel. Only used with --seek, as every worker seeks to its part of the video. Default is number of CPUs.",
+    )
+    parser.add_argument(
+        "-c",
+        "--cuda",
+        required=False,
+        action="store_true",
+        help="Decode and process video on GPU. Requires OpenCV built with CUDA support, falls back to CPU otherwise.",
+    )
+    parser.add_argument(
+        "-a",
+        "--average",
+        required=False,
+        action="store_true",
+        help="Average mean color of a section over all of its frames instead of sampling a single one. More accurate, but every frame has to be decoded.",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
@@ -162,6 +372,10 @@ if __name__ == "__main__":
         color_section_size=args.color_section_size,
         flip_to_vertical=args.flip,
         sampling_interval=args.sampling_interval,
+        use_seeking=args.seek,
+        workers=args.workers,
+        use_cuda=args.cuda,
+        average_sections=args.average,
     )
     cmm.process_image()
     cmm.save_result_to_file(args.output_path)